@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Measures the cold-start time of the shortest invocations of the chef with
+`python -X importtime`: `sushichef.py --help`, which loads the ricecooker stack,
+and `sushichef.py report --help`, which must only load the standard library.
+
+Usage:
+    python benchmarks/import_time.py [--max-help-ms=1000] [--max-report-ms=100]
+                                     [--baseline-rev=<git rev>] [--max-slowdown=0.2]
+                                     [--repeat=5] [--top=10]
+
+`--baseline-rev` runs the same commands on the tree of a git revision, e.g.
+`--baseline-rev=HEAD~1`, and reports the difference. Exits with a non-zero
+status when a command is slower than its budget, or slower than the baseline
+by more than `--max-slowdown`.
+"""
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+  ("sushichef.py --help", ["sushichef.py", "--help"]),
+  ("sushichef.py report --help", ["sushichef.py", "report", "--help"]),
+]
+
+def measure_startup(directory, command):
+  """
+  Runs `command` in a fresh interpreter and returns (wall-clock time in ms,
+  list of (module name, self time in us, cumulative time in us, nesting level)),
+  or None when the command fails.
+  """
+  start = time.perf_counter()
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime"] + command,
+    cwd=directory,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    universal_newlines=True,
+  )
+  wall_ms = (time.perf_counter() - start) * 1000
+
+  imports = []
+  errors = []
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:"):
+      errors.append(line)
+      continue
+    if "[us]" in line:
+      continue
+    self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+    level = (len(name) - len(name.lstrip())) // 2
+    imports.append((name.strip(), int(self_us), int(cumulative_us), level))
+
+  if result.returncode != 0:
+    print("{} failed in {}:\n{}".format(" ".join(command), directory, "\n".join(errors[-10:])))
+    return None
+  return wall_ms, imports
+
+def get_import_ms(imports):
+  # top level imports already include the time of everything they import
+  return sum(cumulative_us for _, _, cumulative_us, level in imports if level == 0) / 1000
+
+def measure_best(directory, command, repeat):
+  runs = []
+  for _ in range(repeat):
+    run = measure_startup(directory, command)
+    if run is None:
+      return None
+    runs.append(run)
+  return min(runs, key=lambda run: run[0])
+
+def extract_revision(revision, directory):
+  archive = subprocess.run(
+    ["git", "archive", revision],
+    cwd=ROOT_DIR,
+    stdout=subprocess.PIPE,
+    check=True,
+  ).stdout
+  with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+    tar.extractall(directory)
+
+def main():
+  parser = argparse.ArgumentParser(description="Cold-start benchmark of the sushichef.py command line")
+  parser.add_argument("--max-help-ms", type=float, default=1000, help="sushichef.py --help budget in milliseconds")
+  parser.add_argument("--max-report-ms", type=float, default=100, help="sushichef.py report --help budget in milliseconds")
+  parser.add_argument("--baseline-rev", help="git revision to compare with")
+  parser.add_argument("--max-slowdown", type=float, default=0.2,
+                      help="fail when slower than the baseline revision by this fraction")
+  parser.add_argument("--repeat", type=int, default=5, help="number of fresh interpreters to measure")
+  parser.add_argument("--top", type=int, default=10, help="number of slowest imports to display")
+  args = parser.parse_args()
+
+  budgets = {
+    "sushichef.py --help": args.max_help_ms,
+    "sushichef.py report --help": args.max_report_ms,
+  }
+
+  baseline_directory = None
+  if args.baseline_rev:
+    baseline_directory = tempfile.mkdtemp()
+    extract_revision(args.baseline_rev, baseline_directory)
+
+  failures = []
+  try:
+    for name, command in COMMANDS:
+      best = measure_best(ROOT_DIR, command, args.repeat)
+      if best is None:
+        failures.append("{} failed".format(name))
+        continue
+      wall_ms, imports = best
+
+      print("{}: best {:.1f} ms wall-clock, {:.1f} ms importing {} modules".format(
+        name, wall_ms, get_import_ms(imports), len(imports)))
+      print("  Slowest imports (cumulative):")
+      for module, _, cumulative_us, level in sorted(imports, key=lambda i: -i[2])[:args.top]:
+        print("    {:>8.1f} ms  {}{}".format(cumulative_us / 1000, "  " * level, module))
+
+      if wall_ms > budgets[name]:
+        failures.append("{} took {:.1f} ms, over the {:.1f} ms budget".format(name, wall_ms, budgets[name]))
+
+      if baseline_directory:
+        baseline = measure_best(baseline_directory, command, args.repeat)
+        if baseline is None:
+          print("  {}: not available".format(args.baseline_rev))
+          continue
+        baseline_wall_ms, baseline_imports = baseline
+        modules = set(module for module, _, _, _ in imports)
+        baseline_modules = set(module for module, _, _, _ in baseline_imports)
+        print("  {}: best {:.1f} ms wall-clock, saved {:.1f} ms, {} modules not imported anymore, {} new modules".format(
+          args.baseline_rev,
+          baseline_wall_ms,
+          baseline_wall_ms - wall_ms,
+          len(baseline_modules - modules),
+          len(modules - baseline_modules),
+        ))
+        if wall_ms > baseline_wall_ms * (1 + args.max_slowdown):
+          failures.append("{} is {:.0%} slower than {}".format(name, wall_ms / baseline_wall_ms - 1, args.baseline_rev))
+  finally:
+    if baseline_directory:
+      shutil.rmtree(baseline_directory)
+
+  for failure in failures:
+    print("FAIL: {}".format(failure))
+  sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compares the JSON decoding backends of `read_source` on recorded API payloads.
+
+Usage:
+    python benchmarks/json_decode.py --record=payloads [--books=50]
+    python benchmarks/json_decode.py payloads/*.json [--repeat=20]
+
+`--record` saves the first search page and the previews of its first `--books`
+books into the given directory. Search pages are also stream-parsed with ijson
+when it is installed; in a run ijson parses the page while it is downloaded,
+here only its parsing cost is measured.
+"""
+import argparse
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sushichef
+
+def record_payloads(directory, books_count):
+  os.makedirs(directory, exist_ok=True)
+
+  url = "{}/book/search?{}".format(sushichef.API_URL_V2, urlencode({"cursor": "", "limit": 100}))
+  source = sushichef.read_source_bytes(url)
+  with open(os.path.join(directory, "search.json"), "wb") as payload_file:
+    payload_file.write(source)
+
+  other_books, featured_books, _ = sushichef.read_search_page(url)
+  for book in ((other_books or []) + (featured_books or []))[:books_count]:
+    url = "{}/book/preview/language/{}/book/{}".format(
+      sushichef.API_URL, book["languageId"], book["masterBookId"])
+    path = os.path.join(directory, "preview-{}-{}.json".format(book["languageId"], book["masterBookId"]))
+    with open(path, "wb") as payload_file:
+      payload_file.write(sushichef.read_source_bytes(url))
+
+def get_decoders():
+  decoders = []
+  for backend in sushichef.JSON_BACKENDS:
+    try:
+      decoders.append((backend, sushichef.get_json_decoder(backend), False))
+    except ImportError:
+      print("{} is not installed, skipping".format(backend))
+  if not importlib.util.find_spec("ijson"):
+    print("ijson is not installed, skipping search pages stream parsing")
+  else:
+    decoders.append(("ijson stream", lambda source: sushichef.parse_search_page_stream(io.BytesIO(source)), True))
+  return decoders
+
+def is_search_page(source):
+  response = json.loads(source)
+  return isinstance(response, dict) and any(key in response for key in sushichef.SEARCH_PAGE_BOOKS_KEYS)
+
+def benchmark(decode, sources, repeat):
+  """
+  Returns the best time in seconds of decoding all `sources`.
+  """
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for source in sources:
+      decode(source)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+def main():
+  parser = argparse.ArgumentParser(description="JSON decoding benchmark of read_source backends")
+  parser.add_argument("payloads", nargs="*", help="recorded JSON payload files")
+  parser.add_argument("--record", metavar="DIRECTORY", help="record payloads into a directory and exit")
+  parser.add_argument("--books", type=int, default=50, help="number of book previews to record")
+  parser.add_argument("--repeat", type=int, default=20, help="number of timed runs per backend")
+  args = parser.parse_args()
+
+  if args.record:
+    record_payloads(args.record, args.books)
+    return
+  if not args.payloads:
+    parser.error("no payloads given, record some with --record")
+
+  sources = []
+  for path in args.payloads:
+    with open(path, "rb") as payload_file:
+      sources.append(payload_file.read())
+  search_pages = [source for source in sources if is_search_page(source)]
+  size_mb = sum(len(source) for source in sources) / 1e6
+
+  print("{} payloads ({} search pages), {:.2f} MB".format(len(sources), len(search_pages), size_mb))
+  print("{:<14} {:>12} {:>12}".format("backend", "all [ms]", "search [ms]"))
+  for name, decode, search_only in get_decoders():
+    all_ms = "-" if search_only else "{:.2f}".format(benchmark(decode, sources, args.repeat) * 1000)
+    search_ms = "{:.2f}".format(benchmark(decode, search_pages, args.repeat) * 1000) if search_pages else "-"
+    print("{:<14} {:>12} {:>12}".format(name, all_ms, search_ms))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Run history of the chef: every chef run appends a record with its performance
+figures and content counts, the report compares the latest run with the previous
+ones. Only uses the standard library so that `python sushichef.py report` doesn't
+load ricecooker.
+"""
+import argparse
+import json
+import sys
+
+# Local run history, one JSON record per run is appended by each chef run
+RUN_HISTORY_PATH = "stats_history.jsonl"
+
+def append_run_history(record, path=RUN_HISTORY_PATH):
+  with open(path, "a") as history_file:
+    history_file.write(json.dumps(record) + "\n")
+
+def read_run_history(path=RUN_HISTORY_PATH):
+  with open(path) as history_file:
+    return [json.loads(line) for line in history_file if line.strip()]
+
+def get_phases_durations(record):
+  return dict(("{} phase [s]".format(phase), duration) for phase, duration in record["phases"].items())
+
+def get_requests_latencies(record):
+  latencies = {}
+  for kind, kind_requests in record["requests"].items():
+    latencies["{} requests latency mean [s]".format(kind)] = kind_requests["latency_mean"]
+    latencies["{} requests latency p95 [s]".format(kind)] = kind_requests["latency_p95"]
+  return latencies
+
+def get_saved_books_per_language(record):
+  books = {}
+  for counts in record["books"]:
+    language = counts["language"] or counts["language_id"]
+    books[language] = books.get(language, 0) + counts["saved"]
+  return books
+
+def get_cache_hit_rates(record):
+  rates = {"book files": record["book_files"]["cache_hit_rate"]}
+  if "api" in record["requests"]:
+    rates["api requests"] = record["requests"]["api"]["http_cache_hit_rate"]
+  return rates
+
+def get_mean(values):
+  return sum(values) / len(values) if values else 0
+
+def find_regressions(latest, baseline, max_slowdown, min_slowdown_seconds, max_cache_drop, max_content_drop):
+  """
+  Compares the latest run history record with the mean of the baseline records
+  and returns a message for each figure that got worse by more than its threshold.
+  """
+  regressions = []
+
+  # the seconds threshold keeps very short phases from flagging noise,
+  # latencies are compared by the slowdown fraction only
+  for get_metrics, min_seconds in [(get_phases_durations, min_slowdown_seconds), (get_requests_latencies, 0)]:
+    baseline_metrics = [get_metrics(record) for record in baseline]
+    for name, value in sorted(get_metrics(latest).items()):
+      baseline_value = get_mean([metrics[name] for metrics in baseline_metrics if name in metrics])
+      if not baseline_value:
+        continue
+      if value > baseline_value * (1 + max_slowdown) and value - baseline_value > min_seconds:
+        regressions.append("{}: {:.2f} vs baseline {:.2f} (+{:.0%})".format(
+          name, value, baseline_value, value / baseline_value - 1))
+
+  latest_cache_hit_rates = get_cache_hit_rates(latest)
+  baseline_cache_hit_rates = [get_cache_hit_rates(record) for record in baseline]
+  for kind, rate in sorted(latest_cache_hit_rates.items()):
+    baseline_rate = get_mean([rates[kind] for rates in baseline_cache_hit_rates if kind in rates])
+    if baseline_rate - rate > max_cache_drop:
+      regressions.append("{} cache hit rate: {:.0%} vs baseline {:.0%}".format(kind, rate, baseline_rate))
+
+  latest_books = get_saved_books_per_language(latest)
+  baseline_books = [get_saved_books_per_language(record) for record in baseline]
+  languages = set(latest_books).union(*baseline_books)
+  for language in sorted(languages):
+    baseline_count = get_mean([books.get(language, 0) for books in baseline_books])
+    count = latest_books.get(language, 0)
+    if baseline_count and (baseline_count - count) / baseline_count > max_content_drop:
+      regressions.append("{} books saved: {} vs baseline {:.1f}".format(language, count, baseline_count))
+
+  return regressions
+
+def print_run_summary(record):
+  print("Run started {}".format(record["started"]))
+  for phase, duration in sorted(record["phases"].items()):
+    print("  {} phase: {:.1f} s".format(phase, duration))
+  for kind, kind_requests in sorted(record["requests"].items()):
+    print("  {} requests: {}, {} failed ({:.1f} MB), latency mean {:.3f} s, p95 {:.3f} s, max {:.3f} s, HTTP cache hit rate {:.0%}".format(
+      kind,
+      kind_requests["count"],
+      kind_requests["failed"],
+      kind_requests["bytes"] / 1e6,
+      kind_requests["latency_mean"],
+      kind_requests["latency_p95"],
+      kind_requests["latency_max"],
+      kind_requests["http_cache_hit_rate"],
+    ))
+  print("  Bytes downloaded: {:.1f} MB".format(record["bytes_downloaded"] / 1e6))
+  print("  Book files: {}, downloaded {}, cache hit rate {:.0%}".format(
+    record["book_files"]["count"], record["book_files"]["downloaded"], record["book_files"]["cache_hit_rate"]))
+  if "files" in record:
+    files = record["files"]
+    print("  Book files: {} references to {} URLs, {} processed once and reused, {:.1f} MB of duplicate downloads avoided".format(
+      files["references"], files["unique_urls"], files.get("reused_references", 0),
+      files.get("duplicate_bytes_avoided", 0) / 1e6))
+    print("  Book files with the same content under different URLs: {} ({:.1f} MB)".format(
+      files["duplicate_content_urls"], files["duplicate_content_bytes"] / 1e6))
+  print("  Books saved / not saved per language and level:")
+  for counts in record["books"]:
+    print("    {} - {}: {} / {}".format(
+      counts["language"] or counts["language_id"], counts["level"], counts["saved"], counts["not_saved"]))
+
+def report(argv):
+  """
+  Compares the latest run from the run history with the rolling baseline of
+  the previous runs. Returns 1 when any regression was found, 0 otherwise.
+  """
+  parser = argparse.ArgumentParser(
+    prog="sushichef.py report",
+    description="Compare the latest chef run with the previous runs and flag regressions."
+  )
+  parser.add_argument("--history", default=RUN_HISTORY_PATH, help="run history file")
+  parser.add_argument("--baseline-runs", type=int, default=5, help="number of previous runs in the baseline")
+  parser.add_argument("--max-slowdown", type=float, default=0.25,
+                      help="flag phases and request latencies slower than the baseline by this fraction")
+  parser.add_argument("--min-slowdown-seconds", type=float, default=1.0,
+                      help="ignore phases slowdowns shorter than this number of seconds")
+  parser.add_argument("--max-cache-drop", type=float, default=0.1,
+                      help="flag cache hit rates lower than the baseline by this fraction")
+  parser.add_argument("--max-content-drop", type=float, default=0.05,
+                      help="flag languages with fewer books saved than the baseline by this fraction")
+  args = parser.parse_args(argv)
+
+  try:
+    history = read_run_history(args.history)
+  except FileNotFoundError:
+    parser.error("no run history found in {}".format(args.history))
+  if not history:
+    parser.error("the run history in {} is empty".format(args.history))
+
+  latest = history[-1]
+  baseline = history[-args.baseline_runs - 1:-1] if args.baseline_runs > 0 else []
+  print_run_summary(latest)
+
+  if not baseline:
+    print("No previous runs to compare with")
+    return 0
+
+  regressions = find_regressions(
+    latest,
+    baseline,
+    max_slowdown=args.max_slowdown,
+    min_slowdown_seconds=args.min_slowdown_seconds,
+    max_cache_drop=args.max_cache_drop,
+    max_content_drop=args.max_content_drop,
+  )
+  print("Compared with the mean of the {} previous runs:".format(len(baseline)))
+  for regression in regressions:
+    print("  REGRESSION {}".format(regression))
+  if not regressions:
+    print("  No regressions")
+
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(report(sys.argv[1:]))
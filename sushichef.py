@@ -1,16 +1,30 @@
 #!/usr/bin/env python
 import csv
+import importlib.util
+import json
 import os
 import sys
-import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache, wraps
 from urllib.parse import urlencode
-from requests.exceptions import HTTPError
-from ricecooker.utils import downloader, html_writer
+
+if __name__ == '__main__' and sys.argv[1:2] == ["report"]:
+    # The report only reads the run history, don't load the ricecooker stack for it
+    import run_history
+    sys.exit(run_history.report(sys.argv[2:]))
+
+from requests.exceptions import HTTPError, RequestException
+from run_history import append_run_history
+from ricecooker import commands, config
+from ricecooker.utils import downloader
 from ricecooker.chefs import SushiChef
-from ricecooker.classes import nodes, files, questions
+from ricecooker.classes import nodes, files
 from ricecooker.config import LOGGER              # Use LOGGER to print messages
 from ricecooker.exceptions import raise_for_invalid_channel
-from le_utils.constants import exercises, content_kinds, file_formats, format_presets, languages, licenses
+from le_utils.constants import licenses
 
 
 # Run constants
@@ -55,6 +69,27 @@ LEVELS_QUERY_VALUES = dict([
   (ID_LEVEL_5, "LEVEL_5"),
 ])
 
+# JSON decoding backends in order of preference, the first one that can be
+# imported is used unless a backend is chosen with `json_backend=<name>`
+JSON_BACKENDS = ["orjson", "json"]
+
+# Arrays of books in a search page response
+SEARCH_PAGE_BOOKS_KEYS = ["other", "featured"]
+
+# Set by `configure_json_decoding`
+json_backend = None
+stream_search_pages = False
+
+# Steps `commands.uploadchannel` runs after `construct_channel`, by the name of
+# the function running them and the name of their phase in the run history
+RICECOOKER_PHASES = [
+  ("process_tree_files", "download_files"),
+  ("get_file_diff", "get_file_diff"),
+  ("upload_files", "upload_files"),
+  ("create_tree", "create_tree"),
+  ("publish_tree", "publish_channel"),
+]
+
 # The chef subclass
 ################################################################################
 class LetsReadAsiaChef(SushiChef):
@@ -68,6 +103,17 @@ class LetsReadAsiaChef(SushiChef):
         'CHANNEL_DESCRIPTION': CHANNEL_DESCRIPTION,    # Description of the channel (optional)
     }
 
+    def run(self, args, options):
+        run_stats.install_session_hooks()
+        run_stats.time_ricecooker_phases()
+        with run_stats.phase("run"):
+            super(LetsReadAsiaChef, self).run(args, options)
+        record = run_stats.get_record()
+        append_run_history(record)
+        LOGGER.info("Book files: {} references to {} URLs, {} processed once and reused, {:.1f} MB of duplicate downloads avoided".format(
+          record["files"]["references"], record["files"]["unique_urls"], record["files"]["reused_references"],
+          record["files"]["duplicate_bytes_avoided"] / 1e6))
+
     def construct_channel(self, *args, **kwargs):
         """
         Creates ChannelNode and build topic tree
@@ -83,43 +129,23 @@ class LetsReadAsiaChef(SushiChef):
                         -> Book
         """
         channel = self.get_channel(*args, **kwargs)  # Create ChannelNode from data in self.channel_info
+        configure_json_decoding(
+          backend=kwargs.get("json_backend"),
+          stream=is_option_enabled(kwargs.get("stream_search_pages")),
+        )
 
         books_saved = []
         books_not_saved = []
 
         try:
-          books = fetch_books_list()
+          with run_stats.phase("fetch_books_list"):
+            books = fetch_books_list()
         except HTTPError:
           LOGGER.error("Could not fetch all books list")
           return
 
-        books_details = {}
-        for book in books:
-          master_book_id = book["masterBookId"]
-          language_id = book["languageId"]
-
-          try:
-            book_detail = fetch_book_detail(master_book_id, language_id)
-          except HTTPError:
-            LOGGER.error("Could not fetch a book detail for \n {}".format(book))
-            books_not_saved.append(book)
-            continue
-
-          books_details[book_detail["id"]] = book_detail
-
-          available_languages = book_detail["availableLanguages"]
-          for language in available_languages:
-            # we already have the book detail for this language
-            if language["id"] == language_id:
-              continue
-
-            try:
-              book_detail = fetch_book_detail(master_book_id, language["id"])
-            except HTTPError:
-              LOGGER.error("Could not fetch a book detail for \n {}".format(book))
-              books_not_saved.append(book)
-            else:
-              books_details[book_detail["id"]] = book_detail
+        with run_stats.phase("fetch_books_details"):
+          books_details = fetch_books_details(books, books_not_saved)
 
         books_details_list = list(books_details.values())
         # make sure that languages and levels will be displayed in a correct order
@@ -127,14 +153,17 @@ class LetsReadAsiaChef(SushiChef):
           key=lambda book_detail: (book_detail["language"]["name"], book_detail["readingLevel"])
         )
 
-        for book_detail in books_details_list:
-          try:
-            save_book(book_detail, channel)
-            books_saved.append(book_detail)
-          except NoFileAvailableError:
-            books_not_saved.append(book_detail)
+        with run_stats.phase("save_books"):
+          for book_detail in books_details_list:
+            try:
+              save_book(book_detail, channel)
+              books_saved.append(book_detail)
+            except NoFileAvailableError:
+              books_not_saved.append(book_detail)
 
         write_stats(books_saved, books_not_saved)
+        run_stats.add_books(books_saved, books_not_saved)
+        run_stats.add_book_files(channel)
 
         raise_for_invalid_channel(channel)  # Check for errors in channel construction
 
@@ -146,6 +175,41 @@ class LetsReadAsiaChef(SushiChef):
 class NoFileAvailableError(Exception):
   pass
 
+def fetch_books_details(books, books_not_saved):
+  """
+  Returns book details of all language versions of `books` by their ids,
+  books whose details could not be fetched are added to `books_not_saved`.
+  """
+  books_details = {}
+  for book in books:
+    master_book_id = book["masterBookId"]
+    language_id = book["languageId"]
+
+    try:
+      book_detail = fetch_book_detail(master_book_id, language_id)
+    except HTTPError:
+      LOGGER.error("Could not fetch a book detail for \n {}".format(book))
+      books_not_saved.append(book)
+      continue
+
+    books_details[book_detail["id"]] = book_detail
+
+    available_languages = book_detail["availableLanguages"]
+    for language in available_languages:
+      # we already have the book detail for this language
+      if language["id"] == language_id:
+        continue
+
+      try:
+        book_detail = fetch_book_detail(master_book_id, language["id"])
+      except HTTPError:
+        LOGGER.error("Could not fetch a book detail for \n {}".format(book))
+        books_not_saved.append(book)
+      else:
+        books_details[book_detail["id"]] = book_detail
+
+  return books_details
+
 def fetch_books_list(books=[], last_cursor=""):
   query_params = {
     "cursor": last_cursor,
@@ -154,10 +218,7 @@ def fetch_books_list(books=[], last_cursor=""):
   }
   url = "{}/book/search?{}".format(API_URL_V2, urlencode(query_params))
 
-  response = read_source(url)
-
-  other_books = response.get("other")
-  featured_books = response.get("featured")
+  other_books, featured_books, last_cursor = read_search_page(url)
 
   if other_books:
     books.extend(other_books)
@@ -165,7 +226,6 @@ def fetch_books_list(books=[], last_cursor=""):
   if featured_books:
     books.extend(featured_books)
 
-  last_cursor = response.get("cursorWebSafeString")
   if last_cursor:
     fetch_books_list(books, last_cursor)
 
@@ -196,10 +256,10 @@ def save_book(book_detail, channel):
 
   book_files = []
   if pdf_url:
-    pdf_file = files.DocumentFile(path=pdf_url)
+    pdf_file = BookDocumentFile(path=pdf_url)
     book_files.append(pdf_file)
   if epub_url:
-    epub_file = files.EPubFile(path=epub_url)
+    epub_file = BookEPubFile(path=epub_url)
     book_files.append(epub_file)
 
   book = nodes.DocumentNode(
@@ -262,8 +322,137 @@ def get_or_create_tag_topic(tag, language_id, level_id, level_topic):
   return topic
 
 def read_source(url):
-  source = downloader.read(url)
-  return json.loads(source)
+  return get_json_decoder(json_backend)(read_source_bytes(url))
+
+def read_source_bytes(url):
+  start = time.perf_counter()
+  response = request_source(url)
+  # decoders parse the raw response body directly without making an intermediate str copy
+  source = response.content
+  run_stats.record_api_response(response, time.perf_counter() - start, len(source))
+  return source
+
+def request_source(url):
+  """
+  Returns the response of an API request like `downloader.read` makes it,
+  records the request and raises HTTPError when it fails.
+  """
+  start = time.perf_counter()
+  response = downloader.make_request(url, clear_cookies=True)
+  if response is None:
+    run_stats.record_api_response(None, time.perf_counter() - start, 0, failed=True)
+    raise HTTPError("Could not connect to {}".format(url))
+  raise_for_api_status(response, start)
+  return response
+
+def request_source_stream(url):
+  """
+  Same as `request_source` but the response body is not read yet. The request
+  is made on the downloader session directly since `downloader.make_request`
+  only streams the body in recent ricecooker versions.
+  """
+  session = downloader.DOWNLOAD_SESSION
+  session.cookies.clear()
+  start = time.perf_counter()
+  try:
+    response = session.get(url, headers=downloader.DEFAULT_HEADERS, stream=True, timeout=60)
+  except RequestException as error:
+    run_stats.record_api_response(None, time.perf_counter() - start, 0, failed=True)
+    raise HTTPError("Could not connect to {}: {}".format(url, error))
+  raise_for_api_status(response, start)
+  return response
+
+def raise_for_api_status(response, start):
+  try:
+    response.raise_for_status()
+  except HTTPError:
+    run_stats.record_api_response(response, time.perf_counter() - start, 0, failed=True)
+    raise
+
+def read_search_page(url):
+  """
+  Returns (other books, featured books, next page cursor) of a search page.
+  """
+  if stream_search_pages:
+    start = time.perf_counter()
+    response = request_source_stream(url)
+    # parse the body while it is downloaded instead of buffering it first
+    response.raw.decode_content = True
+    search_page = parse_search_page_stream(response.raw)
+    run_stats.record_api_response(response, time.perf_counter() - start, response.raw.tell())
+    return search_page
+
+  response = read_source(url)
+  books = [response.get(key) for key in SEARCH_PAGE_BOOKS_KEYS]
+  return books[0], books[1], response.get("cursorWebSafeString")
+
+def parse_search_page_stream(source_file):
+  """
+  Same as `read_search_page` but reads the search page from a file-like object
+  and builds its books one by one from ijson parser events instead of decoding
+  the whole document at once.
+  """
+  import ijson
+  from ijson.common import ObjectBuilder
+
+  books = dict((key, []) for key in SEARCH_PAGE_BOOKS_KEYS)
+  items_prefixes = dict(("{}.item".format(key), key) for key in SEARCH_PAGE_BOOKS_KEYS)
+  cursor = None
+  builder = None
+
+  for prefix, event, value in ijson.parse(source_file, use_float=True):
+    if builder:
+      builder.event(event, value)
+      if prefix in items_prefixes and event == "end_map":
+        books[items_prefixes[prefix]].append(builder.value)
+        builder = None
+    elif prefix in items_prefixes and event == "start_map":
+      builder = ObjectBuilder()
+      builder.event(event, value)
+    elif prefix == "cursorWebSafeString" and event == "string":
+      cursor = value
+
+  return books["other"], books["featured"], cursor
+
+def configure_json_decoding(backend=None, stream=False):
+  """
+  Sets the JSON backend used by `read_source` (one of JSON_BACKENDS, None picks
+  the first available one) and whether search pages are stream-parsed with ijson.
+  """
+  global json_backend, stream_search_pages
+
+  if backend and backend not in JSON_BACKENDS:
+    raise ValueError("Unknown JSON backend {}, use one of {}".format(backend, ", ".join(JSON_BACKENDS)))
+
+  if stream and not importlib.util.find_spec("ijson"):
+    LOGGER.warning("ijson is not installed, search pages will not be stream-parsed")
+    stream = False
+
+  json_backend = backend
+  stream_search_pages = stream
+
+@lru_cache(maxsize=None)
+def get_json_decoder(backend=None):
+  """
+  Returns a function decoding a JSON document from bytes with the given backend,
+  or with the first backend from JSON_BACKENDS that can be imported.
+  """
+  for name in [backend] if backend else JSON_BACKENDS:
+    if name == "orjson":
+      try:
+        import orjson
+      except ImportError:
+        if backend:
+          raise
+        continue
+      return orjson.loads
+    if name == "json":
+      return json.loads
+  raise ValueError("Unknown JSON backend {}".format(backend))
+
+def is_option_enabled(value):
+  # options given on the command line are strings, e.g. stream_search_pages=0
+  return str(value).strip().lower() in ["1", "true", "yes"]
 
 def get_book_source_id(book_id):
   return "{}/book/{}".format(SITE_URL, book_id)
@@ -326,9 +515,255 @@ def write_stats(books_saved, books_not_saved):
     for book in books_not_saved:
       writer.writerow([get_book_source_id(book["id"])])
 
+# File registry
+################################################################################
+
+class FileRegistry(object):
+  """
+  Run-wide registry of the processed book files by URL. Language versions of a
+  book often reference the same file, and a book is added to each of its tag
+  topics, so ricecooker processes the same URL many times, concurrently in its
+  thread pool. The registry runs the first processing of each URL under a lock
+  and gives its result to the other references.
+
+  Files with the same content under different URLs are only known once both are
+  downloaded, they are reported but not deduplicated.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.url_locks = {}
+    self.results = {}
+    self.references_by_url = {}
+    self.reused_by_url = {}
+    self.concurrent_by_url = {}
+
+  def get_url_lock(self, url):
+    with self.lock:
+      self.references_by_url[url] = self.references_by_url.get(url, 0) + 1
+      return self.url_locks.setdefault(url, threading.Lock())
+
+  def process_file(self, file, process):
+    """
+    Returns the filename of `file` like `process` does, `process` only runs for
+    the first reference of the file URL.
+    """
+    url = file.path
+    url_lock = self.get_url_lock(url)
+    if not url_lock.acquire(blocking=False):
+      # Without the registry, this reference would also miss the file cache
+      # while the URL is being processed
+      if url not in self.results:
+        self.concurrent_by_url[url] = self.concurrent_by_url.get(url, 0) + 1
+      url_lock.acquire()
+    try:
+      if url not in self.results:
+        attributes = dict(vars(file))
+        process()
+        # keep everything processing set on the file, e.g. its filename
+        self.results[url] = {
+          key: value for key, value in vars(file).items()
+          if key not in attributes or attributes[key] is not value
+        }
+        return file.filename
+
+      vars(file).update(self.results[url])
+      self.reused_by_url[url] = self.reused_by_url.get(url, 0) + 1
+      if not file.filename and file not in config.FAILED_FILES:
+        config.FAILED_FILES.append(file)
+      return file.filename
+    finally:
+      url_lock.release()
+
+  def get_stats(self, downloaded_urls):
+    """
+    Returns the counts of the file references and reused processings, the size
+    of the duplicate downloads avoided, and of the files with the same content
+    under different URLs. Processing a reused reference again would download its
+    file again with `--update`, or when the first processing downloaded it and
+    the reference was processed concurrently; otherwise it would have been read
+    from ricecooker's file cache.
+    """
+    stats = {
+      "references": sum(self.references_by_url.values()),
+      "unique_urls": len(self.references_by_url),
+      "reused_references": sum(self.reused_by_url.values()),
+      "duplicate_bytes_avoided": 0,
+      "duplicate_content_urls": 0,
+      "duplicate_content_bytes": 0,
+    }
+
+    urls_by_hash = {}
+    for url, result in self.results.items():
+      filename = result.get("filename")
+      if not filename:
+        continue
+      size = os.path.getsize(config.get_storage_path(filename))
+      if config.UPDATE:
+        stats["duplicate_bytes_avoided"] += size * self.reused_by_url.get(url, 0)
+      elif url in downloaded_urls:
+        stats["duplicate_bytes_avoided"] += size * self.concurrent_by_url.get(url, 0)
+
+      content_hash = filename.split(".")[0]  # ricecooker names files by their md5 hash
+      if content_hash in urls_by_hash:
+        stats["duplicate_content_urls"] += 1
+        stats["duplicate_content_bytes"] += size
+      else:
+        urls_by_hash[content_hash] = url
+
+    return stats
+
+file_registry = FileRegistry()
+
+class RegisteredFileMixin(object):
+  """
+  Processes the file through `file_registry`. The registry and its locks are
+  module globals, so the files stay picklable for ricecooker's progress saves.
+  """
+
+  def process_file(self):
+    return file_registry.process_file(self, super(RegisteredFileMixin, self).process_file)
+
+class BookDocumentFile(RegisteredFileMixin, files.DocumentFile):
+  pass
+
+class BookEPubFile(RegisteredFileMixin, files.EPubFile):
+  pass
+
+# Run statistics
+################################################################################
+
+class RunStats(object):
+  """
+  Collects the performance figures and content counts of a chef run,
+  `get_record` returns them as a record of the run history.
+  """
+
+  def __init__(self):
+    self.started = datetime.now()
+    self.phases = {}
+    self.requests = {}
+    self.books = {}
+    self.book_files_urls = set()
+    self.downloaded_files_urls = set()
+
+  @contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+  def time_ricecooker_phases(self):
+    """
+    Times each step of RICECOOKER_PHASES, they are looked up in the `commands`
+    module by `commands.uploadchannel` when it runs them.
+    """
+    for function_name, phase in RICECOOKER_PHASES:
+      setattr(commands, function_name, self.get_timed_function(phase, getattr(commands, function_name)))
+
+  def get_timed_function(self, phase, function):
+    @wraps(function)
+    def timed_function(*args, **kwargs):
+      with self.phase(phase):
+        return function(*args, **kwargs)
+    return timed_function
+
+  def install_session_hooks(self):
+    """
+    Records the HTTP requests of the session ricecooker downloads the files with.
+    Files found in ricecooker's file cache are not requested at all, so these
+    are the downloads of the files missing from the cache.
+    """
+    config.DOWNLOAD_SESSION.hooks["response"].append(self.record_file_response)
+
+  def record_file_response(self, response, *args, **kwargs):
+    # requests calls the hook for each response of a redirect chain, the
+    # redirects are part of the final response's request
+    if response.request.method != "GET" or response.is_redirect:
+      return
+    from_cache = getattr(response, "from_cache", False)
+    failed = not response.ok
+    # files are streamed to disk, don't read them here
+    size = 0 if from_cache or failed else int(response.headers.get("Content-Length") or 0)
+    latency = response.elapsed.total_seconds() + sum(
+      redirect.elapsed.total_seconds() for redirect in response.history)
+    self.add_request("files", latency, size, from_cache, failed)
+    if not from_cache and not failed:
+      url = response.history[0].request.url if response.history else response.request.url
+      self.downloaded_files_urls.add(url)
+
+  def record_api_response(self, response, latency, size, failed=False):
+    """
+    Records an API request, `response` is None when no response was received.
+    """
+    from_cache = getattr(response, "from_cache", False)
+    self.add_request("api", latency, 0 if from_cache else size, from_cache, failed)
+
+  def add_request(self, kind, latency, size, from_cache, failed=False):
+    self.requests.setdefault(kind, []).append((latency, size, from_cache, failed))
+
+  def add_book_files(self, node):
+    for file in node.files:
+      if getattr(file, "path", None):
+        self.book_files_urls.add(file.path)
+    for child in node.children:
+      self.add_book_files(child)
+
+  def add_books(self, books_saved, books_not_saved):
+    for books, key in [(books_saved, "saved"), (books_not_saved, "not_saved")]:
+      for book in books:
+        language = book.get("language") or {}
+        language_id = str(language.get("id", book.get("languageId")))
+        level_id = str(book.get("readingLevel"))
+        counts = self.books.setdefault((language_id, level_id), {
+          "language_id": language_id,
+          "language": language.get("name", ""),
+          "level": LEVELS_NAMES.get(level_id, level_id),
+          "saved": 0,
+          "not_saved": 0,
+        })
+        counts["language"] = counts["language"] or language.get("name", "")
+        counts[key] += 1
+
+  def get_record(self):
+    requests = {}
+    for kind, kind_requests in self.requests.items():
+      latencies = sorted(latency for latency, _, _, _ in kind_requests)
+      requests[kind] = {
+        "count": len(kind_requests),
+        "failed": sum(1 for _, _, _, failed in kind_requests if failed),
+        "latency_mean": sum(latencies) / len(latencies),
+        "latency_p95": latencies[int(0.95 * (len(latencies) - 1))],
+        "latency_max": latencies[-1],
+        "bytes": sum(size for _, size, _, _ in kind_requests),
+        "http_cache_hit_rate": sum(1 for _, _, from_cache, _ in kind_requests if from_cache) / len(kind_requests),
+      }
+
+    # a book file is a cache hit when ricecooker processed it without downloading it
+    downloaded_files = len(self.book_files_urls & self.downloaded_files_urls)
+    book_files = {
+      "count": len(self.book_files_urls),
+      "downloaded": downloaded_files,
+      "cache_hit_rate": 1 - downloaded_files / len(self.book_files_urls) if self.book_files_urls else 0,
+    }
+
+    return {
+      "started": self.started.isoformat(timespec="seconds"),
+      "phases": self.phases,
+      "requests": requests,
+      "bytes_downloaded": sum(kind_requests["bytes"] for kind_requests in requests.values()),
+      "book_files": book_files,
+      "files": file_registry.get_stats(self.downloaded_files_urls),
+      "books": sorted(self.books.values(), key=lambda counts: (counts["language"], counts["level"])),
+    }
+
+run_stats = RunStats()
+
 # CLI
 ################################################################################
 if __name__ == '__main__':
     # This code runs when sushichef.py is called from the command line
     chef = LetsReadAsiaChef()
-    chef.main()
\ No newline at end of file
+    chef.main()